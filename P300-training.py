@@ -13,6 +13,7 @@ import utils
 if __name__ == "__main__":
     subject = 1
     session = "13_normal"  # {}_normal: red/blue, {}_emotion: scared/peace,
+    dtype = None  # np.float32 halves only the uV arrays used to plot and train
     # Read raw data from data set
     raw = utils.load_data(sfreq=256.,
                           subject_nb=subject, session_nb=session,
@@ -38,6 +39,12 @@ if __name__ == "__main__":
     if epochs.events.size == 0:
         print('No epochs')
     else:
+        # Train P300 classifier on real-valued epochs, as P300Service feeds
+        # the saved model.
+        accuracy_score = utils.train_svm_p300(
+            epochs, save_fn='./models/subject_{}.joblib'.format(subject),
+            dtype=dtype)
+
         # See: https://mne.tools/stable/generated/mne.Epochs.html?highlight=apply_hilbert#mne.Epochs.apply_hilbert
         epochs.apply_hilbert()
         # Show Epocs plot with events.
@@ -53,7 +60,4 @@ if __name__ == "__main__":
 
         fig, ax = utils.plot_conditions(epochs, conditions=conditions,
                                         ci=97.5, n_boot=1000, title='',
-                                        diff_waveform=(1, 2))
-
-        # Train P300 classifier.
-        accuracy_score = utils.train_svm_p300(epochs)
+                                        diff_waveform=(1, 2), dtype=dtype)
@@ -0,0 +1,103 @@
+""" Memory used by each stage of P300-training.py on the largest session.
+
+    MNE keeps Raw and Epochs data in float64, so loading, filtering and
+    epoching use the same memory whatever the dtype. The dtype only changes
+    the final uV array made by utils.get_epochs_uv for plotting and training,
+    and that is the only stage expected to shrink in float32.
+
+"""
+
+import os
+import sys
+import json
+import resource
+import subprocess
+import tracemalloc
+from glob import glob
+
+import numpy as np
+from mne import Epochs, find_events
+
+import utils
+
+# Largest allowed peak of each stage, in full float64 arrays of its data.
+# In float32, "to uV" holds half an array plus one chunk of epochs. Filter
+# and epoch are done by MNE, they are only bounded to catch regressions.
+MAX_COPIES = {
+    'float64': {'load': 2.1, 'filter': 7., 'epoch': 1.9, 'to uV': 1.05},
+    'float32': {'load': 2.1, 'filter': 7., 'epoch': 1.9, 'to uV': 0.65},
+}
+# Largest allowed float32 / float64 peak ratio of "to uV"
+MAX_TO_UV_RATIO = 0.65
+
+
+def profile_stages(filepath, dtype):
+    # Peak memory of each stage, in multiples of the float64 array of that
+    # stage, since MNE keeps Raw and Epochs data in float64
+    tracemalloc.start()
+    copies = {}
+
+    def measure(name, func, n_bytes):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        result = func()
+        peak = tracemalloc.get_traced_memory()[1] - before
+        copies[name] = peak / n_bytes(result)
+        print(f'{name:>7}: peak {peak / 2 ** 20:7.1f} MiB = '
+              f'{copies[name]:.2f} full arrays')
+        return result
+
+    raw = measure('load', lambda: utils.load_muse_csv_as_raw(
+        filepath, sfreq=256., ch_ind=[0, 1, 2, 3]),
+        lambda raw: len(raw.ch_names) * raw.n_times * 8)
+    measure('filter', lambda: raw.filter(1, 30, method='iir'),
+            lambda raw: len(raw.ch_names) * raw.n_times * 8)
+    epochs = measure('epoch', lambda: Epochs(
+        raw, events=find_events(raw), event_id={'Non-Target': 1, 'Target': 2},
+        tmin=-0.1, tmax=0.8, baseline=None, reject=None, preload=True,
+        verbose=False, picks=[0, 1, 2, 3]),
+        lambda epochs: (len(epochs) * len(epochs.ch_names) *
+                        len(epochs.times) * 8))
+    measure('to uV', lambda: utils.get_epochs_uv(epochs, dtype=dtype),
+            lambda X: X.size * 8)
+    tracemalloc.stop()
+    return copies
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3:
+        filepath, dtype = sys.argv[1], np.dtype(sys.argv[2])
+        print(f'{dtype}:')
+        # float64 is the default, get_epochs_uv is then called without dtype
+        copies = profile_stages(
+            filepath, None if dtype == np.float64 else dtype)
+        # ru_maxrss is in KiB on Linux
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print(f'peak RSS {peak_rss / 2 ** 10:.1f} MiB')
+
+        for name, max_copies in MAX_COPIES[dtype.name].items():
+            assert copies[name] <= max_copies, (
+                f'{name} made {copies[name]:.2f} full copies in {dtype}, '
+                f'at most {max_copies} expected')
+        # read back by the parent process
+        print('copies: ' + json.dumps(copies))
+        sys.exit()
+
+    # Each dtype runs in its own process so that peak RSS is not shared
+    filepath = max(glob('./data/subject_*/session_*.csv'), key=os.path.getsize)
+    print(f'Largest session: {filepath}')
+    copies = {}
+    for dtype in MAX_COPIES:
+        output = subprocess.run([sys.executable, __file__, filepath, dtype],
+                                check=True, capture_output=True,
+                                text=True).stdout
+        print(output, end='')
+        copies[dtype] = json.loads(
+            [line for line in output.splitlines()
+             if line.startswith('copies: ')][-1][len('copies: '):])
+
+    ratio = copies['float32']['to uV'] / copies['float64']['to uV']
+    print(f'to uV: float32 peak is {ratio:.2f} of float64')
+    assert ratio <= MAX_TO_UV_RATIO, (
+        f'float32 to uV peak is {ratio:.2f} of float64, '
+        f'at most {MAX_TO_UV_RATIO} expected')
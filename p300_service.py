@@ -0,0 +1,294 @@
+""" Local P300 inference service.
+
+    1. A model saved by `utils.train_svm_p300` is loaded once.
+    2. EEG samples and markers are read from LSL (or a local socket for tests).
+    3. Epochs are scored in micro-batches and decisions are published as
+       [label, score] on the 'P300Decisions' LSL stream (or the socket).
+
+"""
+
+import json
+import time
+import socket
+import logging
+import selectors
+from collections import deque
+
+import numpy as np
+from scipy import signal
+from pylsl import (StreamInfo, StreamOutlet, StreamInlet, resolve_byprop,
+                   IRREGULAR_RATE)
+
+import utils
+
+
+logger = logging.getLogger(__name__)
+
+
+class LSLTransport:
+    def __init__(self, n_channels, timeout=2):
+        """Reads the EEG and Markers LSL streams and publishes decisions.
+
+        Parameters:
+            n_channels (int): number of EEG channels used by the model.
+            timeout (float): time to look for the streams in seconds.
+        """
+        self.n_channels = n_channels
+        eeg_streams = resolve_byprop("type", "EEG", timeout=timeout)
+        marker_streams = resolve_byprop("type", "Markers", timeout=timeout)
+        if not eeg_streams or not marker_streams:
+            raise RuntimeError("Can't find EEG and Markers streams.")
+        # No processing flags: timestamps are kept as sent, see
+        # utils.find_marker_onsets
+        self.eeg_inlet = StreamInlet(eeg_streams[0], max_chunklen=12)
+        self.marker_inlet = StreamInlet(marker_streams[0])
+
+        info = StreamInfo("P300Decisions", "Markers", 2, IRREGULAR_RATE,
+                          "float32", "p300service")
+        self.outlet = StreamOutlet(info)
+
+    def pull(self, timeout):
+        samples, timestamps = self.eeg_inlet.pull_chunk(timeout=timeout)
+        markers, marker_timestamps = self.marker_inlet.pull_chunk(timeout=0.)
+        samples = np.array(samples).reshape(-1, self.eeg_inlet.channel_count)
+        return (samples[:, :self.n_channels], np.array(timestamps),
+                [m[0] for m in markers],
+                np.array(marker_timestamps))
+
+    def publish(self, timestamps, labels, scores):
+        for timestamp, label, score in zip(timestamps, labels, scores):
+            self.outlet.push_sample([label, score], timestamp)
+
+
+class SocketTransport:
+    def __init__(self, n_channels, host="127.0.0.1", port=8300):
+        """Same as LSLTransport over newline delimited JSON on a local TCP
+        socket. Clients send {"eeg": [[...]], "timestamps": [...]} and
+        {"marker": 2, "timestamp": t}, and receive
+        {"timestamp": t, "label": 2, "score": 0.7} for every scored marker.
+
+        Parameters:
+            n_channels (int): number of EEG channels used by the model.
+            host (str): address to listen on.
+            port (int): port to listen on, 0 to pick a free one.
+        """
+        self.n_channels = n_channels
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen()
+        self.server.setblocking(False)
+        self.address = self.server.getsockname()
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.server, selectors.EVENT_READ)
+        self.clients = {}
+
+    def pull(self, timeout):
+        samples, timestamps, markers, marker_timestamps = [], [], [], []
+        for key, _ in self.selector.select(timeout=timeout):
+            if key.fileobj is self.server:
+                client, _ = self.server.accept()
+                client.setblocking(False)
+                self.selector.register(client, selectors.EVENT_READ)
+                self.clients[client] = b""
+                continue
+
+            client = key.fileobj
+            try:
+                data = client.recv(65536)
+            except OSError:
+                data = b""
+            if not data:
+                self._drop(client)
+                continue
+            *lines, self.clients[client] = (self.clients[client] +
+                                            data).split(b"\n")
+            try:
+                for line in lines:
+                    message = json.loads(line)
+                    if "eeg" in message:
+                        eeg = np.array(message["eeg"], dtype=float).reshape(
+                            -1, self.n_channels)
+                        eeg_timestamps = np.array(message["timestamps"],
+                                                  dtype=float)
+                        if len(eeg) != len(eeg_timestamps):
+                            raise ValueError("one timestamp per sample")
+                        samples.append(eeg)
+                        timestamps.append(eeg_timestamps)
+                    else:
+                        marker = int(message["marker"])
+                        marker_timestamp = float(message["timestamp"])
+                        markers.append(marker)
+                        marker_timestamps.append(marker_timestamp)
+            except (ValueError, KeyError, TypeError) as error:
+                # json.JSONDecodeError is a ValueError
+                logger.warning("dropping client sending %r: %s", line, error)
+                self._drop(client)
+
+        if samples:
+            samples = np.concatenate(samples)
+            timestamps = np.concatenate(timestamps)
+        else:
+            samples = np.zeros((0, self.n_channels))
+            timestamps = np.zeros(0)
+        return samples, timestamps, markers, np.array(marker_timestamps)
+
+    def publish(self, timestamps, labels, scores):
+        lines = b"".join(
+            json.dumps({"timestamp": float(t), "label": int(label),
+                        "score": float(score)}).encode() + b"\n"
+            for t, label, score in zip(timestamps, labels, scores))
+        for client in list(self.clients):
+            try:
+                client.sendall(lines)
+            except OSError as error:
+                # closed, reset, or too slow to empty its buffer
+                logger.warning("dropping client: %s", error)
+                self._drop(client)
+
+    def _drop(self, client):
+        # Only this client is closed, the service keeps running
+        self.selector.unregister(client)
+        del self.clients[client]
+        client.close()
+
+
+class P300Service:
+    def __init__(self, model_fn, transport=None, max_batch=16, max_wait=0.02,
+                 markers=(1, 2), n_latencies=1000):
+        """Loads the model once and scores every marker of the stream.
+
+        Parameters:
+            model_fn (str): model file saved by utils.save_model.
+            transport (LSLTransport or SocketTransport): where data comes
+                from and decisions go. If None, use LSL.
+            max_batch (int): maximum number of epochs scored at once.
+            max_wait (float): maximum time in seconds a ready epoch waits
+                for the batch to fill up.
+            markers (tuple): markers to score, e.g. (Non-target, Target).
+            n_latencies (int): number of recent decisions used for the
+                latency percentiles.
+        """
+        model = utils.load_model(model_fn)
+        self.clf = model["clf"]
+        self.sfreq = model["sfreq"]
+        self.n_channels = len(model["ch_names"])
+        self.n_times = model["n_times"]
+        self._onset = int(round(model["tmin"] * self.sfreq))
+        self.transport = transport or LSLTransport(self.n_channels)
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.markers = markers
+
+        # Same band as the training raw, but causal since data is streamed
+        self._sos = signal.butter(4, [model["l_freq"], model["h_freq"]],
+                                  btype="band", fs=self.sfreq, output="sos")
+        self._zi = None
+
+        # keep enough samples for the longest epoch plus some delay
+        self._buffer = np.zeros((0, self.n_channels))
+        self._timestamps = np.zeros(0)
+        self._max_samples = int(self.n_times + 10 * self.sfreq)
+        self._pending = deque()
+        self._ready = []
+        self._latencies = deque(maxlen=n_latencies)
+        self._running = False
+
+    def _append(self, samples, timestamps):
+        if self._zi is None:
+            self._zi = (signal.sosfilt_zi(self._sos)[:, :, None] *
+                        samples[0][None, None])
+        samples, self._zi = signal.sosfilt(self._sos, samples, axis=0,
+                                           zi=self._zi)
+        self._buffer = np.concatenate([self._buffer, samples])[
+            -self._max_samples:]
+        self._timestamps = np.concatenate([self._timestamps, timestamps])[
+            -self._max_samples:]
+
+    def _collect_ready(self):
+        # Move every marker whose epoch is fully recorded to the batch
+        now = time.perf_counter()
+        while self._pending:
+            marker_timestamp = self._pending[0]
+            start = (utils.find_marker_onsets(self._timestamps,
+                                              marker_timestamp) +
+                     self._onset)
+            if start < 0:
+                self._pending.popleft()
+                continue
+            if start + self.n_times > len(self._buffer):
+                break
+            self._ready.append(
+                (marker_timestamp, now,
+                 self._buffer[start:start + self.n_times].T.ravel()))
+            self._pending.popleft()
+
+    def _score(self):
+        marker_timestamps, ready_times, X = zip(*self._ready)
+        self._ready = []
+        X = np.stack(X)
+        labels = self.clf.predict(X)
+        if hasattr(self.clf, "decision_function"):
+            scores = self.clf.decision_function(X)
+        else:
+            scores = np.zeros(len(X))
+        self.transport.publish(marker_timestamps, labels, scores)
+
+        published = time.perf_counter()
+        self._latencies.extend(published - t for t in ready_times)
+
+    def step(self, timeout=0.005):
+        """
+        Pull new data, then score the ready epochs if the batch is full or
+        the oldest one waited max_wait.
+        """
+        samples, timestamps, markers, marker_timestamps = \
+            self.transport.pull(timeout)
+        if len(samples):
+            self._append(samples, timestamps)
+        for marker, marker_timestamp in zip(markers, marker_timestamps):
+            if marker in self.markers:
+                self._pending.append(marker_timestamp)
+        self._collect_ready()
+
+        if self._ready and (
+                len(self._ready) >= self.max_batch or
+                time.perf_counter() - self._ready[0][1] >= self.max_wait):
+            self._score()
+
+    def latency(self):
+        """
+        Returns:
+            (float): p50 decision latency in ms
+            (float): p99 decision latency in ms
+        """
+        if not self._latencies:
+            return 0., 0.
+        p50, p99 = np.percentile(self._latencies, [50, 99])
+        return 1e3 * p50, 1e3 * p99
+
+    def run(self, report_every=10.):
+        """
+        Score markers until stop() is called, logging the latency
+        percentiles every report_every seconds.
+        """
+        self._running = True
+        last_report = time.perf_counter()
+        while self._running:
+            self.step()
+            if time.perf_counter() - last_report >= report_every:
+                p50, p99 = self.latency()
+                logger.info("decision latency p50 %.2f ms, p99 %.2f ms",
+                            p50, p99)
+                last_report = time.perf_counter()
+
+    def stop(self):
+        self._running = False
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    subject = 1
+    service = P300Service('./models/subject_{}.joblib'.format(subject))
+    service.run()
@@ -0,0 +1,248 @@
+import os
+import time
+from glob import glob
+from math import comb
+from itertools import combinations, islice
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import stats
+from mne import Epochs, find_events
+
+import utils
+
+
+# Load target ERPs of one condition ('normal' or 'emotion') from every session
+def load_condition_data(subject_nb, condition, sfreq=256., event_id=2,
+                        tmin=-0.1, tmax=0.8, average=True, dtype=None):
+    """Load epochs of every session of a condition into a single array.
+    Args:
+        subject_nb (int or str): subject number.
+        condition (str): session suffix, e.g. 'normal' or 'emotion'.
+    Keyword Args:
+        sfreq (float): EEG sampling frequency
+        event_id (int): marker of the epochs to keep (2: Target)
+        tmin (float): start of the epoch in seconds
+        tmax (float): end of the epoch in seconds
+        average (bool): if True, return one averaged ERP per session,
+            otherwise return every single epoch of every session.
+        dtype (numpy.dtype or None): dtype of the returned data, see
+            utils.get_epochs_uv
+    Returns:
+        (numpy.ndarray): data in uV, (n_observations, n_channels, n_times)
+        (numpy.ndarray): time of each sample in seconds
+    """
+    data_paths = sorted(glob(os.path.join(
+        './data/',
+        'subject_{}/session_*_{}.csv'.format(subject_nb, condition))))
+    if len(data_paths) == 0:
+        raise RuntimeError('No session found for condition {}.'.format(
+            condition))
+
+    X = []
+    for data_path in data_paths:
+        raw = utils.load_muse_csv_as_raw(data_path, sfreq=sfreq,
+                                         ch_ind=[0, 1, 2, 3])
+        raw.filter(1, 30, method='iir')
+        events = find_events(raw)
+        # Epochs raises when none of the events match, skip such sessions
+        if not np.any(events[:, -1] == event_id):
+            continue
+        epochs = Epochs(raw, events=events,
+                        event_id={'Target': event_id}, tmin=tmin, tmax=tmax,
+                        baseline=None, reject=None, preload=True,
+                        verbose=False, picks=[0, 1, 2, 3])
+        session = utils.get_epochs_uv(epochs, dtype=dtype)
+        X.append(session.mean(axis=0, keepdims=True) if average else session)
+
+    if len(X) == 0:
+        raise RuntimeError('No session of condition {} has marker {}.'.format(
+            condition, event_id))
+    return np.concatenate(X), epochs.times
+
+
+def _t_statistics(A, X, sum_all, sumsq_all, n1, n2):
+    # A: (n_perm, n_obs) group membership, X: (n_obs, n_features)
+    sum1 = A @ X
+    sumsq1 = A @ (X * X)
+    sum2 = sum_all - sum1
+    sumsq2 = sumsq_all - sumsq1
+
+    mean1 = sum1 / n1
+    mean2 = sum2 / n2
+    ss = (sumsq1 - sum1 * mean1) + (sumsq2 - sum2 * mean2)
+    var = ss / (n1 + n2 - 2) * (1. / n1 + 1. / n2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (mean1 - mean2) / np.sqrt(var)
+    return np.nan_to_num(t)
+
+
+def _label_clusters(T, threshold):
+    """Label supra-threshold runs along the last axis of T.
+    Returns:
+        (numpy.ndarray): flat index of the start of each cluster
+        (numpy.ndarray): flat index of the end (exclusive) of each cluster
+        (numpy.ndarray): sum of T over each cluster
+    """
+    mask = T > threshold
+    starts = mask.copy()
+    starts[..., 1:] &= ~mask[..., :-1]
+    ends = mask.copy()
+    ends[..., :-1] &= ~mask[..., 1:]
+
+    labels = np.cumsum(starts.ravel()) * mask.ravel()
+    n_clusters = int(np.count_nonzero(starts))
+    mass = np.bincount(labels, weights=T.ravel() * mask.ravel(),
+                       minlength=n_clusters + 1)[1:]
+    return np.flatnonzero(starts), np.flatnonzero(ends) + 1, mass
+
+
+def _max_cluster_mass(T, threshold):
+    # Largest absolute cluster mass of each permutation, T: (n_perm, ...)
+    n_perm = T.shape[0]
+    row_size = T[0].size
+    max_mass = np.zeros(n_perm)
+    for sign in (1, -1):
+        start, _, mass = _label_clusters(sign * T, threshold)
+        np.maximum.at(max_mass, start // row_size, mass)
+    return max_mass
+
+
+# Shared by every worker of the pool so that X is sent only once per process
+_worker_state = {}
+
+
+def _init_worker(X, n1, threshold):
+    sum_all = X.sum(axis=0)
+    sumsq_all = (X * X).sum(axis=0)
+    # Observed split: the first n1 observations belong to the first group
+    A = (np.arange(X.shape[0]) < n1)[None].astype(X.dtype)
+    t_obs = _t_statistics(A, X, sum_all, sumsq_all, n1, X.shape[0] - n1)[0]
+    _worker_state.update(X=X, n1=n1, threshold=threshold, sum_all=sum_all,
+                         sumsq_all=sumsq_all, t_obs=t_obs)
+
+
+def _splits(task, n_obs, n1):
+    # Each row marks the observations of the first group of one split
+    kind, first, second = task
+    if kind == 'random':
+        rng = np.random.default_rng(first)
+        return np.argsort(rng.random((second, n_obs)), axis=1) < n1
+    # 'exact': splits first to second of the list of every split
+    groups = np.array(list(islice(combinations(range(n_obs), n1),
+                                  first, second)))
+    A = np.zeros((len(groups), n_obs), dtype=bool)
+    A[np.arange(len(groups))[:, None], groups] = True
+    return A
+
+
+def _run_chunk(task, shape):
+    state = _worker_state
+    X, n1 = state['X'], state['n1']
+    n_obs = X.shape[0]
+
+    A = _splits(task, n_obs, n1).astype(X.dtype)
+    n_perm = len(A)
+    T = _t_statistics(A, X, state['sum_all'], state['sumsq_all'],
+                      n1, n_obs - n1)
+
+    counts = (np.abs(T) >= np.abs(state['t_obs'])).sum(axis=0)
+    max_mass = _max_cluster_mass(T.reshape((n_perm,) + shape),
+                                 state['threshold'])
+    return counts, max_mass
+
+
+def permutation_cluster_test(X1, X2, n_permutations=5000, threshold=None,
+                             tail_alpha=0.05, chunk_size=500, n_jobs=None,
+                             seed=42):
+    """Compare two conditions at every channel and time point.
+    Student t statistics of every permutation are computed as matrix
+    products over a chunk of permutations, and chunks are spread over a
+    process pool so that memory is bounded by chunk_size.
+    Args:
+        X1 (numpy.ndarray): first condition, (n_obs1, n_channels, n_times)
+        X2 (numpy.ndarray): second condition, (n_obs2, n_channels, n_times)
+    Keyword Args:
+        n_permutations (int): number of random permutations. If there are
+            at most this many distinct splits of the observations, every
+            split is used once instead.
+        threshold (float or None): cluster forming |t| threshold. If None,
+            use the two-tailed t value at tail_alpha.
+        tail_alpha (float): alpha used to derive the default threshold
+        chunk_size (int): number of permutations computed at once
+        n_jobs (int or None): number of processes. If None, use all CPUs.
+        seed (int): seed of the random permutations
+    Returns:
+        (dict): 't_obs' (n_channels, n_times) observed t values,
+            'p_values' (n_channels, n_times) uncorrected permutation
+            p-values, 'clusters' list of (channel, tmin index, tmax index,
+            mass, p-value) corrected by the max cluster mass,
+            'n_permutations' number of permutations actually used, and
+            'perm_per_sec' permutations per second.
+    """
+    n1, n2 = len(X1), len(X2)
+    shape = X1.shape[1:]
+    X = np.concatenate([X1, X2]).reshape(n1 + n2, -1)
+    # t values don't depend on the offset, so center for numerical stability
+    X = X - X.mean(axis=0)
+    if threshold is None:
+        threshold = stats.t.ppf(1 - tail_alpha / 2, n1 + n2 - 2)
+
+    # Observed split: the first n1 observations belong to the first group
+    A = (np.arange(n1 + n2) < n1)[None].astype(X.dtype)
+    t_obs = _t_statistics(A, X, X.sum(axis=0), (X * X).sum(axis=0),
+                          n1, n2)[0].reshape(shape)
+
+    n_splits = comb(n1 + n2, n1)
+    exact = n_splits <= n_permutations
+    if exact:
+        # Few enough splits to use each one once, the observed one included
+        n_permutations = n_splits
+        tasks = [('exact', first, min(first + chunk_size, n_splits))
+                 for first in range(0, n_splits, chunk_size)]
+    else:
+        sizes = [chunk_size] * (n_permutations // chunk_size)
+        if n_permutations % chunk_size:
+            sizes.append(n_permutations % chunk_size)
+        seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+        tasks = [('random', seed, size) for seed, size in zip(seeds, sizes)]
+
+    start = time.perf_counter()
+    if n_jobs == 1:
+        _init_worker(X, n1, threshold)
+        try:
+            results = [_run_chunk(task, shape) for task in tasks]
+        finally:
+            _worker_state.clear()
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs,
+                                 initializer=_init_worker,
+                                 initargs=(X, n1, threshold)) as executor:
+            results = list(executor.map(_run_chunk, tasks,
+                                        [shape] * len(tasks)))
+    elapsed = time.perf_counter() - start
+
+    counts = sum(r[0] for r in results)
+    max_mass = np.concatenate([r[1] for r in results])
+    # The observed split is counted once more unless it was enumerated
+    extra = 0. if exact else 1.
+
+    clusters = []
+    for sign in (1, -1):
+        starts, ends, mass = _label_clusters(sign * t_obs, threshold)
+        for cluster_start, cluster_end, cluster_mass in zip(starts, ends,
+                                                            mass):
+            ch, tmin = np.unravel_index(cluster_start, shape)
+            p = (np.sum(max_mass >= cluster_mass) + extra) / \
+                (n_permutations + extra)
+            clusters.append((int(ch), int(tmin),
+                             int(tmin + cluster_end - cluster_start),
+                             sign * cluster_mass, p))
+    clusters.sort(key=lambda c: c[-1])
+
+    return {'t_obs': t_obs,
+            'p_values': ((counts + extra) /
+                         (n_permutations + extra)).reshape(shape),
+            'clusters': clusters,
+            'n_permutations': n_permutations,
+            'perm_per_sec': n_permutations / elapsed}
@@ -0,0 +1,343 @@
+""" Live view of the EEG while recording.
+
+    1. A background thread pulls samples from `EEG.get_recent` into a ring buffer.
+    2. The figure is redrawn with blitting: a min/max decimated scope of each
+       channel, a running Welch PSD and a running ERP average per marker.
+
+"""
+
+import time
+import threading
+from collections import deque
+
+import numpy as np
+from matplotlib import pyplot as plt
+from matplotlib.animation import FuncAnimation
+from pylsl import StreamInlet, resolve_byprop
+
+import utils
+from EEG import EEG
+
+
+class RealtimeMonitor:
+    def __init__(
+        self,
+        eeg,
+        n_channels=4,
+        window=5.,
+        chunk=12,
+        width=500,
+        ylim=(-200, 200),
+        psd_window=256,
+        psd_average=8,
+        erp_tmin=-0.1,
+        erp_tmax=0.8,
+        markers=(1, 2),
+        fps=30,
+    ):
+        """The monitor reads from an already started EEG device and only keeps
+        the last `window` seconds in memory.
+
+        Parameters:
+            eeg (EEG): device to read samples from with get_recent.
+            n_channels (int): number of EEG channels to show.
+            window (float): length of the scope in seconds.
+            chunk (int): number of samples pulled at once.
+            width (int): maximum number of min/max buckets drawn per channel.
+            ylim (tuple): (ymin, ymax) of the scope in uV.
+            psd_window (int): length of a Welch segment in samples.
+            psd_average (int): number of segments in the running PSD.
+            erp_tmin (float): start of the ERP epoch in seconds.
+            erp_tmax (float): end of the ERP epoch in seconds.
+            markers (tuple): markers to average, e.g. (Non-target, Target).
+            fps (int): target frame rate of the figure.
+        """
+        self.eeg = eeg
+        self.n_channels = n_channels
+        self.chunk = chunk
+        self.sfreq = float(eeg.sfreq)
+        self.fps = fps
+        self.ylim = ylim
+
+        self.n_samples = int(window * self.sfreq)
+        self._buffer = np.zeros((self.n_samples, n_channels))
+        self._timestamps = np.zeros(self.n_samples)
+        # total number of samples written, the ring buffer position is this
+        # modulo n_samples
+        self._n_written = 0
+        self._lock = threading.Lock()
+        self._running = False
+
+        # min/max decimation: each bucket is drawn as a vertical segment, at
+        # most width buckets cover the window but for less than one bucket
+        self._bucket = int(np.ceil(self.n_samples / width))
+        self.n_buckets = self.n_samples // self._bucket
+        bucket_times = (np.arange(self.n_buckets) * self._bucket -
+                        self.n_buckets * self._bucket) / self.sfreq
+        self._scope_times = np.repeat(bucket_times, 2)
+
+        # Running Welch PSD, only new segments are transformed
+        self.psd_window = psd_window
+        self._psd_step = psd_window // 2
+        self._psd_taper = np.hanning(psd_window)
+        self._psd_scale = 2. / (self.sfreq * np.sum(self._psd_taper ** 2))
+        self._psd_segments = deque(maxlen=psd_average)
+        self._psd_sum = np.zeros((psd_window // 2 + 1, n_channels))
+        self._psd_next = 0
+        self.freqs = np.fft.rfftfreq(psd_window, 1. / self.sfreq)
+
+        # Running ERP average per marker
+        self._erp_start = int(round(erp_tmin * self.sfreq))
+        self._erp_stop = int(round(erp_tmax * self.sfreq))
+        self.erp_times = np.arange(self._erp_start, self._erp_stop) / self.sfreq
+        self._erp_sum = {m: np.zeros((len(self.erp_times), n_channels))
+                         for m in markers}
+        self._erp_count = {m: 0 for m in markers}
+        self._pending_markers = deque()
+        self._marker_inlet = None
+
+        # intervals between the starts of consecutive frames, so they include
+        # the restore, draw and blit of the canvas
+        self._frame_times = deque(maxlen=fps)
+        self._last_frame = None
+        self._cpu_share = 0.
+        self._last_cpu = (time.process_time(), time.perf_counter())
+
+    ##########################
+    #   Acquisition thread   #
+    ##########################
+    def _acquire(self):
+        while self._running:
+            df = self.eeg.get_recent(n_samples=self.chunk)
+            if len(df):
+                self._write(df.values[:, :self.n_channels],
+                            df.index.values)
+            if self._marker_inlet is not None:
+                markers, timestamps = self._marker_inlet.pull_chunk(
+                    timeout=0.)
+                for marker, timestamp in zip(markers, timestamps):
+                    self.push_marker(marker[0], timestamp)
+
+    def _write(self, samples, timestamps):
+        n = min(len(samples), self.n_samples)
+        samples, timestamps = samples[-n:], timestamps[-n:]
+        with self._lock:
+            start = self._n_written % self.n_samples
+            first = min(n, self.n_samples - start)
+            self._buffer[start:start + first] = samples[:first]
+            self._buffer[:n - first] = samples[first:]
+            self._timestamps[start:start + first] = timestamps[:first]
+            self._timestamps[:n - first] = timestamps[first:]
+            self._n_written += n
+
+    def push_marker(self, marker, timestamp):
+        """
+        Add a marker to the running ERP average once its epoch is recorded.
+
+        Parameters:
+            marker (int): marker number for the stimuli being presented.
+            timestamp (float): timestamp of stimulus onset from time.time() function.
+        """
+        if marker in self._erp_sum:
+            self._pending_markers.append((marker, timestamp))
+
+    def _ordered(self, n_last):
+        # Last n_last samples in time order, copies at most n_last rows
+        end = self._n_written % self.n_samples
+        idx = np.arange(end - n_last, end) % self.n_samples
+        return self._buffer[idx], self._timestamps[idx]
+
+    #####################
+    #   Running stats   #
+    #####################
+    def _update_psd(self):
+        oldest = self._n_written - self.n_samples
+        self._psd_next = max(self._psd_next, oldest)
+        while self._psd_next + self.psd_window <= self._n_written:
+            idx = np.arange(self._psd_next, self._psd_next + self.psd_window)
+            segment = self._buffer[idx % self.n_samples]
+            segment = segment - segment.mean(axis=0)
+            spectrum = np.abs(np.fft.rfft(
+                segment * self._psd_taper[:, None], axis=0)) ** 2
+            spectrum *= self._psd_scale
+
+            if len(self._psd_segments) == self._psd_segments.maxlen:
+                self._psd_sum -= self._psd_segments[0]
+            self._psd_segments.append(spectrum)
+            self._psd_sum += spectrum
+            self._psd_next += self._psd_step
+
+    def _update_erp(self):
+        if not self._n_written:
+            return
+        n_valid = min(self._n_written, self.n_samples)
+        data, timestamps = self._ordered(n_valid)
+        while self._pending_markers:
+            marker, timestamp = self._pending_markers[0]
+            onset = utils.find_marker_onsets(timestamps, timestamp)
+            if onset + self._erp_start < 0:
+                # epoch already left the ring buffer
+                self._pending_markers.popleft()
+                continue
+            if onset + self._erp_stop > n_valid:
+                break
+            self._erp_sum[marker] += data[onset + self._erp_start:
+                                          onset + self._erp_stop]
+            self._erp_count[marker] += 1
+            self._pending_markers.popleft()
+
+    def decimate(self):
+        """
+        Min/max decimation of the scope window.
+
+        Returns:
+            (numpy.ndarray): (2 * n_buckets, n_channels) alternating min and
+                max of each bucket, with the channel mean removed
+        """
+        n = self.n_buckets * self._bucket
+        data, _ = self._ordered(n)
+        data = data.reshape(self.n_buckets, self._bucket, self.n_channels)
+        decimated = np.empty((self.n_buckets, 2, self.n_channels))
+        np.min(data, axis=1, out=decimated[:, 0])
+        np.max(data, axis=1, out=decimated[:, 1])
+        decimated = decimated.reshape(-1, self.n_channels)
+        decimated -= decimated.mean(axis=0)
+        return decimated
+
+    def stats(self):
+        """
+        Returns:
+            (float): mean time between frames in ms over the last second
+            (float): share of one CPU used by the process since the last call
+        """
+        if self._frame_times:
+            frame_time = 1e3 * np.mean(self._frame_times)
+        else:
+            frame_time = 0.
+        return frame_time, self._cpu_share
+
+    #################
+    #   Rendering   #
+    #################
+    def _init_figure(self, ch_names):
+        fig = plt.figure(figsize=[14, 7])
+        grid = fig.add_gridspec(self.n_channels, 2)
+
+        self._scope_lines = []
+        for ch in range(self.n_channels):
+            ax = fig.add_subplot(grid[ch, 0])
+            line, = ax.plot(self._scope_times,
+                            np.zeros(len(self._scope_times)), lw=0.8)
+            ax.set_xlim(self._scope_times[0], 0)
+            ax.set_ylim(self.ylim)
+            ax.set_ylabel(ch_names[ch])
+            self._scope_lines.append(line)
+        ax.set_xlabel('Time (s)')
+
+        half = self.n_channels // 2
+        psd_ax = fig.add_subplot(grid[:half, 1])
+        self._psd_lines = psd_ax.plot(
+            self.freqs, np.zeros((len(self.freqs), self.n_channels)), lw=1)
+        psd_ax.set_xlim(0, min(60, self.sfreq / 2))
+        psd_ax.set_ylim(-20, 40)
+        psd_ax.set_xlabel('Frequency (Hz)')
+        psd_ax.set_ylabel('PSD (dB)')
+        psd_ax.legend(ch_names[:self.n_channels], loc='upper right')
+
+        erp_ax = fig.add_subplot(grid[half:, 1])
+        self._erp_lines = {}
+        for marker, style in zip(self._erp_sum, ['--', '-', ':']):
+            self._erp_lines[marker] = erp_ax.plot(
+                self.erp_times,
+                np.zeros((len(self.erp_times), self.n_channels)),
+                style, lw=1)
+        erp_ax.set_xlim(self.erp_times[0], self.erp_times[-1])
+        erp_ax.set_ylim(-20, 20)
+        erp_ax.axvline(x=0, color='k', lw=1)
+        erp_ax.set_xlabel('Time (s)')
+        erp_ax.set_ylabel('Amplitude (uV)')
+
+        self._erp_text = erp_ax.text(0.01, 0.95, '', va='top',
+                                     transform=erp_ax.transAxes)
+        self._stats_text = psd_ax.text(0.01, 0.95, '', va='top',
+                                       transform=psd_ax.transAxes)
+        plt.tight_layout()
+        return fig
+
+    def _draw_frame(self, _):
+        start = time.perf_counter()
+        if self._last_frame is not None:
+            self._frame_times.append(start - self._last_frame)
+        self._last_frame = start
+
+        with self._lock:
+            decimated = self.decimate()
+            self._update_psd()
+            self._update_erp()
+
+        for ch, line in enumerate(self._scope_lines):
+            line.set_ydata(decimated[:, ch])
+
+        if self._psd_segments:
+            psd = 10 * np.log10(self._psd_sum / len(self._psd_segments) +
+                                np.finfo(float).tiny)
+            for ch, line in enumerate(self._psd_lines):
+                line.set_ydata(psd[:, ch])
+
+        for marker, lines in self._erp_lines.items():
+            if self._erp_count[marker]:
+                erp = self._erp_sum[marker] / self._erp_count[marker]
+                erp = erp - erp.mean(axis=0)
+                for ch, line in enumerate(lines):
+                    line.set_ydata(erp[:, ch])
+        self._erp_text.set_text('  '.join(
+            'marker {}: {}'.format(m, c) for m, c in self._erp_count.items()))
+
+        # CPU share covers the whole process, acquisition thread included
+        cpu, wall = time.process_time(), time.perf_counter()
+        if wall - self._last_cpu[1] >= 1.:
+            self._cpu_share = ((cpu - self._last_cpu[0]) /
+                               (wall - self._last_cpu[1]))
+            self._last_cpu = (cpu, wall)
+        frame_time, cpu_share = self.stats()
+        fps = 1e3 / frame_time if frame_time else 0.
+        self._stats_text.set_text(
+            'frame {:.1f} ms ({:.0f} fps)  CPU {:.0f}%'.format(
+                frame_time, fps, 100 * cpu_share))
+
+        return (self._scope_lines + self._psd_lines +
+                [line for lines in self._erp_lines.values() for line in lines] +
+                [self._erp_text, self._stats_text])
+
+    def run(self, ch_names=('TP9', 'AF7', 'AF8', 'TP10'), marker_stream=True):
+        """
+        Starts the acquisition thread and shows the figure until it is closed.
+
+        Parameters:
+            ch_names (tuple): name of each shown channel.
+            marker_stream (bool): if True, read markers from the LSL
+                'Markers' stream, otherwise only from push_marker.
+        """
+        if marker_stream:
+            streams = resolve_byprop("type", "Markers", timeout=2)
+            if streams:
+                self._marker_inlet = StreamInlet(streams[0])
+
+        self._running = True
+        acquisition = threading.Thread(target=self._acquire, daemon=True)
+        acquisition.start()
+
+        fig = self._init_figure(list(ch_names))
+        self._animation = FuncAnimation(fig, self._draw_frame,
+                                        interval=1000. / self.fps,
+                                        blit=True, cache_frame_data=False)
+        plt.show()
+
+        self._running = False
+        acquisition.join()
+
+
+if __name__ == "__main__":
+    # Reads the stream started by visual-p300.py (or `muselsl stream`)
+    eeg_device = EEG(device="muse2")
+    RealtimeMonitor(eeg_device).run()
@@ -1,13 +1,18 @@
-import numpy as np
-from scipy import stats
+import permutation_stats
 
-emotion_amp = np.array([1.5022015438913226e-06+2, 2.9991080957324925e-05+1,  3.306975670426566e-05+1, 3.1065984953710082e-06+9, 1.5792118161280203e-06+7, 1.7290505648843897e-05+7])
+if __name__ == "__main__":
+    subject = 1
 
-normal_amp = np.array([1.2282360084000212e-06+1, 3.0504679299505008e-05-2, 3.24790595655191e-05+1, 4.004124340695277e-06-1, 3.6227581557084395e-06-2 ,2.6200937302143214e-06-4])
+    # Target ERP averaged per session, (n_sessions, n_channels, n_times) in uV
+    normal, times = permutation_stats.load_condition_data(subject, 'normal')
+    emotion, _ = permutation_stats.load_condition_data(subject, 'emotion')
 
-emotion_latency = np.array([0.3984375, 0.37109375, 0.328125, 0.37109375, 0.39453125,0.390625])
-normal_latency = np.array([0.34375, 0.33203125,0.31640625, 0.33203125,  0.3359375, 0.30859375 ])
+    result = permutation_stats.permutation_cluster_test(
+        normal, emotion, n_permutations=10000, chunk_size=1000)
 
-result = stats.ttest_ind(normal_amp, emotion_amp, equal_var=True)
-
-print(result)
+    print(f'{result["n_permutations"]} permutations, '
+          f'{result["perm_per_sec"]:.0f} permutations/s')
+    ch_names = ['TP9', 'AF7', 'AF8', 'TP10']
+    for ch, start, stop, mass, p in result['clusters']:
+        print(f'{ch_names[ch]}: {times[start]:.3f}-{times[stop - 1]:.3f} s, '
+              f'mass {mass:.1f}, p = {p:.4f}')
@@ -0,0 +1,110 @@
+import os
+
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn import svm
+
+import utils
+from p300_service import LSLTransport, P300Service
+
+SESSION = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                       'data', 'subject_1', 'session_13_normal.csv')
+N_SAMPLES = 4000
+N_TIMES = 231
+
+
+def load_session():
+    # [timestamps, TP9, AF7, AF8, TP10, Right AUX, Marker]
+    data = pd.read_csv(SESSION).values[:N_SAMPLES]
+    return data[:, 0], data[:, 1:6], data[:, 6].astype(int)
+
+
+class FakeEEGInlet:
+    channel_count = 5
+
+    def __init__(self, timestamps, samples, chunk=12):
+        self.timestamps, self.samples, self.chunk = timestamps, samples, chunk
+        self.pulled = 0
+
+    def pull_chunk(self, timeout):
+        start, self.pulled = self.pulled, self.pulled + self.chunk
+        return (self.samples[start:self.pulled].tolist(),
+                self.timestamps[start:self.pulled].tolist())
+
+
+class FakeMarkerInlet:
+    def __init__(self, eeg_inlet, timestamps, markers):
+        # Markers arrive once the EEG stream has reached their onset
+        self.eeg_inlet = eeg_inlet
+        self.onsets = np.flatnonzero(markers)
+        self.timestamps, self.markers = timestamps, markers
+        self.sent = 0
+
+    def pull_chunk(self, timeout):
+        onsets = self.onsets[self.sent:]
+        onsets = onsets[onsets < self.eeg_inlet.pulled]
+        self.sent += len(onsets)
+        return ([[m] for m in self.markers[onsets]],
+                self.timestamps[onsets].tolist())
+
+
+class FakeOutlet:
+    def __init__(self):
+        self.samples = []
+
+    def push_sample(self, sample, timestamp):
+        self.samples.append((sample, timestamp))
+
+
+def make_transport():
+    # LSLTransport without resolving streams, the inlets replay the
+    # recorded session with its recorded timestamps
+    timestamps, samples, markers = load_session()
+    transport = LSLTransport.__new__(LSLTransport)
+    transport.n_channels = 4
+    transport.eeg_inlet = FakeEEGInlet(timestamps, samples)
+    transport.marker_inlet = FakeMarkerInlet(transport.eeg_inlet, timestamps,
+                                             markers)
+    transport.outlet = FakeOutlet()
+    return transport
+
+
+def save_fake_model(model_fn):
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(20, 4 * N_TIMES))
+    clf = svm.SVC().fit(X, np.r_[[1] * 10, [2] * 10])
+    joblib.dump({'clf': clf, 'sfreq': 256., 'ch_names': ['TP9', 'AF7',
+                                                         'AF8', 'TP10'],
+                 'tmin': -0.1, 'n_times': N_TIMES, 'l_freq': 1.,
+                 'h_freq': 30.}, model_fn)
+
+
+def test_find_marker_onsets_on_recorded_session():
+    timestamps, _, markers = load_session()
+    onsets = np.flatnonzero(markers)
+    assert len(onsets) > 0
+    np.testing.assert_array_equal(
+        utils.find_marker_onsets(timestamps, timestamps[onsets]), onsets)
+
+
+def test_service_scores_every_recorded_marker(tmp_path):
+    model_fn = str(tmp_path / 'model.joblib')
+    save_fake_model(model_fn)
+    transport = make_transport()
+    service = P300Service(model_fn, transport=transport, max_wait=0.)
+
+    while transport.eeg_inlet.pulled < N_SAMPLES:
+        service.step(timeout=0.)
+    service.step(timeout=0.)
+
+    timestamps, _, markers = load_session()
+    onsets = np.flatnonzero(markers)
+    start = onsets + int(round(-0.1 * 256))
+    complete = onsets[(start >= 0) & (start + N_TIMES <= N_SAMPLES)]
+    assert len(complete) > 0
+
+    published = [timestamp for _, timestamp in transport.outlet.samples]
+    np.testing.assert_allclose(published, timestamps[complete])
+    p50, p99 = service.latency()
+    assert 0 <= p50 <= p99
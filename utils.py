@@ -13,6 +13,7 @@ import numpy as np  # Module that simplifies computations on matrices
 from pylsl import StreamInlet, resolve_byprop  # Module to receive EEG data
 import serial
 import time
+import joblib
 from sklearn.pipeline import make_pipeline
 from pyriemann.estimation import ERPCovariances
 from pyriemann.classification import MDM
@@ -78,11 +79,16 @@ def load_muse_csv_as_raw(filepath, sfreq=256., ch_ind=[0, 1, 2, 3],
 
     raw = []
 
-    # read the file [channels(4), aux, marker]
-    data = pd.read_csv(filepath, index_col=0)
-    print(data.columns)
+    # read the file [timestamps, channels(4), aux, marker] in one pass. The
+    # header is split by hand since it can miss the Marker name, the data
+    # is read by position, only the kept channels
+    with open(filepath) as f:
+        columns = f.readline().rstrip('\r\n').split(',')[1:]
+        data = pd.read_csv(f, header=None,
+                           usecols=[i + 1 for i in ch_ind + [stim_ind]])
+    print(columns)
     # name of each channels [channels, stim]
-    ch_names = list(data.columns)[0:n_channel] + ['Stim']
+    ch_names = columns[0:n_channel] + ['Stim']
     print(ch_names)
 
     if replace_ch_names is not None:
@@ -92,15 +98,21 @@ def load_muse_csv_as_raw(filepath, sfreq=256., ch_ind=[0, 1, 2, 3],
     # type of each channels
     ch_types = ['eeg'] * n_channel + ['stim']
 
-    # get data and exclude Aux channel [{num of data}, 5]
-    data = data.values[:, ch_ind + [stim_ind]].T
-    # convert in Volts (from uVolts)
-    data[:-1] *= 1e-6
+    kept = sorted(ch_ind + [stim_ind])
+
+    # [5, {num of data}], filled column by column without a 2D temporary,
+    # and converted in Volts (from uVolts) on the way
+    values = np.empty((n_channel + 1, len(data)))
+    for row, i in enumerate(ch_ind):
+        np.multiply(data.iloc[:, kept.index(i)].values, 1e-6, out=values[row])
+    values[-1] = data.iloc[:, kept.index(stim_ind)].values
+    del data
 
     # create MNE object
     info = create_info(ch_names=ch_names, ch_types=ch_types,
                        sfreq=sfreq)
-    raw.append(RawArray(data=data, info=info))
+    # RawArray keeps float64 data as is, so this is the only copy of the data
+    raw.append(RawArray(data=values, info=info))
     # concatenate all raw objects
     raws = concatenate_raws(raw)
 
@@ -137,9 +149,45 @@ def stream_data(eeg_data, ch_names, ch_ind,):
     return concatenate_raws(raw)
 
 
+def get_epochs_uv(epochs, dtype=None, chunk_size=16):
+    """Get the data of epochs in uV.
+    Args:
+        epochs (mne.epochs): EEG epochs
+    Keyword Args:
+        dtype (numpy.dtype or None): real dtype of the returned array, e.g.
+            np.float32 to halve its memory. If None, keep the dtype of the
+            epochs (float64, or complex128 after apply_hilbert). MNE keeps
+            the epochs themselves in float64, only this array shrinks.
+        chunk_size (int): number of epochs read at once when casting
+    Returns:
+        (numpy.ndarray): (n_epochs, n_channels, n_times) data in uV
+    """
+    n_epochs = len(epochs)
+    first = None
+    if dtype is not None:
+        # a single epoch tells whether the data is complex
+        first = epochs.get_data(item=slice(0, 1))
+    if first is None or np.iscomplexobj(first) or first.dtype == dtype:
+        # get_data already returns a copy, so convert it in place
+        X = epochs.get_data()
+        X *= 1e6
+        return X
+
+    # Read a few epochs at a time so that only the smaller array is held
+    # in full, instead of the float64 copy of get_data and the cast array
+    X = np.empty((n_epochs,) + first.shape[1:], dtype=dtype)
+    del first
+    for start in range(0, n_epochs, chunk_size):
+        chunk = epochs.get_data(item=slice(start, start + chunk_size))
+        np.multiply(chunk, 1e6, out=X[start:start + len(chunk)])
+        # free the chunk before the next one is read
+        del chunk
+    return X
+
+
 def plot_conditions(epochs, conditions=OrderedDict(), ci=97.5, n_boot=1000,
                     title='', palette=None, ylim=(-11, 12),
-                    diff_waveform=(1, 2)):
+                    diff_waveform=(1, 2), dtype=None):
     """Plot ERP conditions.
     Args:
         epochs (mne.epochs): EEG epochs
@@ -157,6 +205,8 @@ def plot_conditions(epochs, conditions=OrderedDict(), ci=97.5, n_boot=1000,
         diff_waveform (tuple or None): tuple of ints indicating which
             conditions to subtract for producing the difference waveform.
             If None, do not plot a difference waveform
+        dtype (numpy.dtype or None): dtype of the plotted uV array, see
+            get_epochs_uv. It doesn't change the memory used by epochs.
     Returns:
         (matplotlib.figure.Figure): figure object
         (list of matplotlib.axes._subplots.AxesSubplot): list of axes
@@ -167,7 +217,7 @@ def plot_conditions(epochs, conditions=OrderedDict(), ci=97.5, n_boot=1000,
     if palette is None:
         palette = sns.color_palette("hls", len(conditions) + 1)
 
-    X = epochs.get_data() * 1e6
+    X = get_epochs_uv(epochs, dtype=dtype)
     times = epochs.times
     y = pd.Series(epochs.events[:, -1])
 
@@ -254,6 +304,21 @@ def connect_to_eeg_stream():
 
     return raw_data
 
+def find_marker_onsets(timestamps, marker_timestamps):
+    """Find the sample at which each marker was presented.
+    The EEG samples streamed by muselsl and the markers pushed by
+    EEG.push_sample are both stamped with time.time(), as in the recorded
+    CSV files, so they are compared as is, without any clock conversion.
+    Args:
+        timestamps (numpy.ndarray): increasing timestamps of the EEG samples
+        marker_timestamps (float or numpy.ndarray): timestamps of the markers
+    Returns:
+        (int or numpy.ndarray): index of the first sample at or after each
+            marker
+    """
+    return np.searchsorted(timestamps, marker_timestamps)
+
+
  # See: https://mne.tools/stable/auto_tutorials/evoked/30_eeg_erp.html?highlight=amplitude#amplitude-and-latency-measures
 
 
@@ -266,22 +331,27 @@ def calculate_amp_and_lat_at_peak(epochs):
     return amp, lat
 
 
-def train_svm_p300(epochs):
+def train_svm_p300(epochs, save_fn=None, dtype=None):
+    # dtype only applies to the uV array built from epochs, see get_epochs_uv
     # Cross-validation (Using ERPCovariances, MDM)
     clf = make_pipeline(ERPCovariances(), MDM())
     epochs.pick_types(eeg=True)
-    X = epochs.get_data() * 1e6  # (194, 4, 232)
-    X = X.reshape(X.shape[0], -1)  # Convert to 2D (194, ~)
+    X = get_epochs_uv(epochs, dtype=dtype)  # (194, 4, 232)
+    if np.iscomplexobj(X):
+        # P300Service feeds the saved model with real-valued epochs
+        raise ValueError('Train on real-valued epochs, before apply_hilbert.')
     times = epochs.times
     y = epochs.events[:, -1]  # (194,)
 
     cv = StratifiedShuffleSplit(
         n_splits=10, test_size=0.25, random_state=42)
 
-    # Cross validation
+    # Cross validation, ERPCovariances takes (n_epochs, n_channels, n_times)
     res = cross_val_score(clf, X, y == 2,
                           scoring='roc_auc', cv=cv, n_jobs=-1)
 
+    X = X.reshape(X.shape[0], -1)  # Convert to 2D (194, ~)
+
     # Make SVM model for specifying if P300 or Non-P300
     X_train, X_test, y_train, y_test = train_test_split(X, y)
     clf = svm.SVC()
@@ -289,4 +359,38 @@ def train_svm_p300(epochs):
 
     y_pred = clf.predict(X_test)
     print(accuracy_score(y_test, y_pred))
+
+    if save_fn:
+        save_model(clf, epochs, save_fn)
     return accuracy_score
+
+
+def save_model(clf, epochs, save_fn):
+    """Save a trained classifier with what is needed to build its input.
+    Args:
+        clf (sklearn estimator): classifier trained on epochs in uV,
+            reshaped to (n_epochs, n_channels * n_times)
+        epochs (mne.epochs): epochs the classifier was trained on
+        save_fn (str): path of the model file
+    """
+    model = {'clf': clf,
+             'sfreq': epochs.info['sfreq'],
+             'ch_names': epochs.ch_names,
+             'tmin': epochs.tmin,
+             'n_times': len(epochs.times),
+             # band of the filter applied to raw before epoching
+             'l_freq': epochs.info['highpass'],
+             'h_freq': epochs.info['lowpass']}
+    os.makedirs(os.path.dirname(os.path.abspath(save_fn)), exist_ok=True)
+    joblib.dump(model, save_fn)
+
+
+def load_model(model_fn):
+    """Load a model saved by save_model.
+    Args:
+        model_fn (str): path of the model file
+    Returns:
+        (dict): 'clf' the classifier, and 'sfreq', 'ch_names', 'tmin',
+            'n_times', 'l_freq', 'h_freq' describing its input
+    """
+    return joblib.load(model_fn)